@@ -21,10 +21,13 @@ import getpass
 import json
 
 from queue import Queue
-from threading import Thread
-from time import time
+from threading import Thread, Lock, local
+from time import time, perf_counter, thread_time
 import logging
 import os
+import contextlib
+import cProfile
+import tracemalloc
 
 
 
@@ -54,18 +57,21 @@ def get_tiles(municipalityId: int) -> pd.DataFrame:
         + f'/grids/municipalities/{municipalityId}'
     )
 
-    data = oauth.get(api_request, headers=headers).json()
+    with profile_stage("api"):
+        data = oauth.get(api_request, headers=headers).json()
     if(data.get('status') == None):
-        tileID = [t['tileId'] for t in data['tiles']]
-        ll_lon = [t['ll']['x'] for t in data['tiles']]
-        ll_lat= [t['ll']['y'] for t in data['tiles']]
-        ur_lon = [t['ur']['x'] for t in data['tiles']]
-        ur_lat = [t['ur']['y'] for t in data['tiles']]
+        with profile_stage("decode"):
+            tileID = [t['tileId'] for t in data['tiles']]
+            ll_lon = [t['ll']['x'] for t in data['tiles']]
+            ll_lat= [t['ll']['y'] for t in data['tiles']]
+            ur_lon = [t['ur']['x'] for t in data['tiles']]
+            ur_lat = [t['ur']['y'] for t in data['tiles']]
     else:
         print(f'get_tiles: failed with status code {data.get("status")}. {data.get("message")}')
         return pd.DataFrame(data={'tileID': [], 'll_lat': [], 'll_lon': [], 'ur_lat': [], 'ur_lon': []})
     
-    return pd.DataFrame(data={'tileID': tileID, 'll_lat': ll_lat, 'll_lon': ll_lon, 'ur_lat': ur_lat, 'ur_lon': ur_lon})
+    with profile_stage("dataframe"):
+        return pd.DataFrame(data={'tileID': tileID, 'll_lat': ll_lat, 'll_lon': ll_lon, 'ur_lat': ur_lat, 'ur_lon': ur_lon})
 
 
 
@@ -156,14 +162,17 @@ def get_daily_demographics(tiles, day=datetime(year=2020, month=1, day=27, hour=
                 + "?tiles="
                 + "&tiles=".join(map(str, tiles_subset))
             )
-            data = oauth.get(api_request, headers=headers).json()
-            for t in data.get("tiles", []):
-                if date2score.get(t['tileId']) == None:
-                    date2score[t['tileId']] = dict()
-                date2score[t['tileId']] = {"ageDistribution": t.get("ageDistribution"),"maleProportion": t.get("maleProportion")}
+            with profile_stage("api"):
+                data = oauth.get(api_request, headers=headers).json()
+            with profile_stage("decode"):
+                for t in data.get("tiles", []):
+                    if date2score.get(t['tileId']) == None:
+                        date2score[t['tileId']] = dict()
+                    date2score[t['tileId']] = {"ageDistribution": t.get("ageDistribution"),"maleProportion": t.get("maleProportion")}
     
     
-    return pd.DataFrame.from_dict(date2score).transpose()
+    with profile_stage("dataframe"):
+        return pd.DataFrame.from_dict(date2score).transpose()
 
 
 
@@ -246,11 +255,13 @@ def get_hourly_demographics_dataframe(tiles, day=datetime(year=2020, month=1, da
                     + "?tiles="
                     + "&tiles=".join(map(str, tiles_subset))
                 )
-                data = oauth.get(api_request, headers=headers).json()
-                for t in data.get("tiles", []):
-                    if date2score.get(t['tileId']) == None:
-                        date2score[t['tileId']] = dict()
-                    date2score.get(t['tileId'])[dt.isoformat()] = {"ageDistribution": t.get("ageDistribution"),"maleProportion": t.get("maleProportion")}
+                with profile_stage("api"):
+                    data = oauth.get(api_request, headers=headers).json()
+                with profile_stage("decode"):
+                    for t in data.get("tiles", []):
+                        if date2score.get(t['tileId']) == None:
+                            date2score[t['tileId']] = dict()
+                        date2score.get(t['tileId'])[dt.isoformat()] = {"ageDistribution": t.get("ageDistribution"),"maleProportion": t.get("maleProportion")}
         return date2score
     
     
@@ -261,22 +272,26 @@ def get_hourly_demographics_dataframe(tiles, day=datetime(year=2020, month=1, da
     age_distribution = []
     age_cat = []
     male_proportion = []
-    for i in data:
-        for time in data[i]:
-            if data[i][time].get("ageDistribution") != None:
-                for (idx,a) in enumerate(data[i][time].get("ageDistribution", [])):
-                    age_cat.append(idx)
-                    age_distribution.append(a)
+    with profile_stage("decode"):
+        for i in data:
+            for time in data[i]:
+                if data[i][time].get("ageDistribution") != None:
+                    for (idx,a) in enumerate(data[i][time].get("ageDistribution", [])):
+                        age_cat.append(idx)
+                        age_distribution.append(a)
+                        tile_id.append(i)
+                        time_data.append(time)
+                        male_proportion.append(data[i][time].get("maleProportion"))
+                else:
                     tile_id.append(i)
                     time_data.append(time)
+                    age_distribution.append(None)
                     male_proportion.append(data[i][time].get("maleProportion"))
-            else:
-                tile_id.append(i)
-                time_data.append(time)
-                age_distribution.append(None)
-                male_proportion.append(data[i][time].get("maleProportion"))
-                age_cat.append(None)
-    return pd.DataFrame(data={'tileID': tile_id, "age_cat": age_cat, 'age_distribution':age_distribution, "male_proportion": male_proportion, 'time': time_data}).set_index(['tileID', 'time'])
+                    age_cat.append(None)
+    with profile_stage("dataframe"):
+        df = pd.DataFrame(data={'tileID': tile_id, "age_cat": age_cat, 'age_distribution':age_distribution, "male_proportion": male_proportion, 'time': time_data})
+    with profile_stage("set_index"):
+        return df.set_index(['tileID', 'time'])
 
 
 
@@ -325,12 +340,17 @@ def get_daily_density(tiles: np.array(int), day=datetime(year=2020, month=1, day
                 + "?tiles="
                 + "&tiles=".join(map(str, tiles_subset))
             )
-            data = oauth.get(api_request, headers=headers).json()
+            with profile_stage("api"):
+                data = oauth.get(api_request, headers=headers).json()
             if data.get("tiles") != None:
-                for t in data["tiles"]:
-                    tileID.append(t['tileId'])
-                    score.append(t["score"])
-    return pd.DataFrame(data={'tileID': tileID, 'score':score}).set_index("tileID")
+                with profile_stage("decode"):
+                    for t in data["tiles"]:
+                        tileID.append(t['tileId'])
+                        score.append(t["score"])
+    with profile_stage("dataframe"):
+        df = pd.DataFrame(data={'tileID': tileID, 'score':score})
+    with profile_stage("set_index"):
+        return df.set_index("tileID")
 
 
 
@@ -382,10 +402,13 @@ def get_hourly_density_dataframe(tiles, day=datetime(year=2020, month=1, day=27,
                     + "?tiles="
                     + "&tiles=".join(map(str, tiles_subset))
                 )
-                for t in oauth.get(api_request, headers=headers).json().get("tiles",[]):
-                    if date2score.get(t['tileId']) == None:
-                        date2score[t['tileId']] = dict()
-                    date2score.get(t['tileId'])[dt.isoformat()] = t['score']
+                with profile_stage("api"):
+                    data = oauth.get(api_request, headers=headers).json()
+                with profile_stage("decode"):
+                    for t in data.get("tiles",[]):
+                        if date2score.get(t['tileId']) == None:
+                            date2score[t['tileId']] = dict()
+                        date2score.get(t['tileId'])[dt.isoformat()] = t['score']
 
         return date2score
     
@@ -394,18 +417,26 @@ def get_hourly_density_dataframe(tiles, day=datetime(year=2020, month=1, day=27,
     time_data = []
     score = []
     data = get_hourly_density(tiles, day)
-    for t in data:
-        for time in data[t]:
-            time_data.append(time)
-            tiles_data.append(t)
-            score.append(data[t][time])
-    return pd.DataFrame(data={'tileID': tiles_data, 'score':score, 'time': time_data}).set_index(['tileID', 'time'])
+    with profile_stage("decode"):
+        for t in data:
+            for time in data[t]:
+                time_data.append(time)
+                tiles_data.append(t)
+                score.append(data[t][time])
+    with profile_stage("dataframe"):
+        df = pd.DataFrame(data={'tileID': tiles_data, 'score':score, 'time': time_data})
+    with profile_stage("set_index"):
+        return df.set_index(['tileID', 'time'])
 
 
 
 
 def fetch_data_city(city: str) -> None:
     """Fetches the data for a city if the data is not yet cashed on the computer.
+    
+    When profiling is enabled (see PROFILE_MODES) the time spent in every stage is recorded
+    per dataset and with the cprofile mode a cProfile dump of the whole city is written to
+    ./data/profile/<city>.prof
     """
     compression = ".xz"
     folder = os.path.join(".","data")
@@ -422,22 +453,43 @@ def fetch_data_city(city: str) -> None:
     daily_density_path = file_path(f'{city}DensityDaily.pkl{compression}')
     daily_demographics_path = file_path(f'{city}DemographicsDaily.pkl{compression}')
 
-
-    if not(os.path.isfile(tiles_path)):
-        tiles = get_tiles(get_municipalityID(city)[0])
-        tiles.to_pickle(tiles_path)
-    else:
-        tiles = pd.read_pickle(tiles_path)
-    if not(os.path.isfile(hourly_dem_path)):
-        hourly_dem = get_hourly_demographics_dataframe(tiles['tileID'].to_numpy())
-        hourly_dem.to_pickle(hourly_dem_path)
-    if not(os.path.isfile(hourly_density_path)):
-        hourly_dens = get_hourly_density_dataframe(tiles['tileID'].to_numpy())
-        hourly_dens.to_pickle(hourly_density_path)
-    if not(os.path.isfile(daily_density_path)):
-        get_daily_density(tiles['tileID'].to_numpy()).to_pickle(daily_density_path)
-    if not(os.path.isfile(daily_demographics_path)):
-        get_daily_demographics(tiles['tileID'].to_numpy()).to_pickle(daily_demographics_path)
+    if PROFILE_CPROFILE:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if not(os.path.isfile(tiles_path)):
+            with profile_dataset(city, "Tiles"):
+                tiles = get_tiles(get_municipalityID(city)[0])
+                with profile_stage("storage"):
+                    tiles.to_pickle(tiles_path)
+        else:
+            tiles = pd.read_pickle(tiles_path)
+        if not(os.path.isfile(hourly_dem_path)):
+            with profile_dataset(city, "HourlyDemographics"):
+                hourly_dem = get_hourly_demographics_dataframe(tiles['tileID'].to_numpy())
+                with profile_stage("storage"):
+                    hourly_dem.to_pickle(hourly_dem_path)
+        if not(os.path.isfile(hourly_density_path)):
+            with profile_dataset(city, "HourlyDensity"):
+                hourly_dens = get_hourly_density_dataframe(tiles['tileID'].to_numpy())
+                with profile_stage("storage"):
+                    hourly_dens.to_pickle(hourly_density_path)
+        if not(os.path.isfile(daily_density_path)):
+            with profile_dataset(city, "DensityDaily"):
+                daily_dens = get_daily_density(tiles['tileID'].to_numpy())
+                with profile_stage("storage"):
+                    daily_dens.to_pickle(daily_density_path)
+        if not(os.path.isfile(daily_demographics_path)):
+            with profile_dataset(city, "DemographicsDaily"):
+                daily_dem = get_daily_demographics(tiles['tileID'].to_numpy())
+                with profile_stage("storage"):
+                    daily_dem.to_pickle(daily_demographics_path)
+    finally:
+        if PROFILE_CPROFILE:
+            profiler.disable()
+            if not(os.path.exists(file_path("profile"))):
+                os.mkdir(file_path("profile"))
+            profiler.dump_stats(file_path(os.path.join("profile", f'{city}.prof')))
 
 
 def clean_cities_list(cities: [str]) -> [str]:
@@ -470,6 +522,107 @@ def clean_cities_list(cities: [str]) -> [str]:
     return [c for c in cities if not(c in invalid_cities)]
 
 
+# Profiling
+
+profile_records = dict()
+profile_lock = Lock()
+profile_context = local()
+
+
+@contextlib.contextmanager
+def profile_dataset(city: str, dataset: str):
+    """Attributes the stages executed in the block to a city and dataset.
+    
+    The whole block is also recorded as the "total" stage of the dataset. Does nothing if PROFILE is disabled.
+    
+    Args:
+        city: name of the city being fetched.
+        dataset: name of the dataset being fetched, same as the suffix of the stored file.
+    """
+    if not(PROFILE):
+        yield
+        return
+    profile_context.key = (city, dataset)
+    try:
+        with profile_stage("total"):
+            yield
+    finally:
+        profile_context.key = None
+
+
+@contextlib.contextmanager
+def profile_stage(stage: str):
+    """Records wall time, CPU time and with the alloc mode the allocations of the block under the current city and dataset.
+    
+    Stages with the same name are accumulated, so wrapping every API call of a dataset adds up to
+    the total time spent waiting on the API for that dataset. Does nothing if PROFILE is disabled
+    or if the block is not inside profile_dataset().
+    
+    The CPU time is measured for the current thread only. Two allocation values are recorded:
+        net_alloc: memory allocated during the block and still allocated at its end, summed over the calls.
+        peak_alloc: highest amount of memory allocated during the block at the same time, maximum over the calls.
+    Memory allocated before the block and freed during it is not subtracted, so both values are
+    positive. tracemalloc is process wide, when several DownloadWorker are running the
+    allocations of a stage include the ones done by the other threads.
+    
+    Args:
+        stage: name of the stage, one of api, decode, dataframe, set_index, storage or total.
+    """
+    key = getattr(profile_context, "key", None)
+    if not(PROFILE) or key == None:
+        yield
+        return
+    if PROFILE_ALLOC:
+        # tracemalloc has a single counter and peak, both are reset by clear_traces() at the start
+        # of every stage. The enclosing stages keep in allocs [memory allocated before the last
+        # reset, highest peak] so that their own values are still correct at their end.
+        allocs = profile_context.__dict__.setdefault("allocs", [])
+        (memory, peak) = tracemalloc.get_traced_memory()
+        for a in allocs:
+            a[1] = max(a[1], a[0] + peak)
+            a[0] += memory
+        allocs.append([0, 0])
+        tracemalloc.clear_traces()
+    wall = perf_counter()
+    cpu = thread_time()
+    try:
+        yield
+    finally:
+        wall = perf_counter() - wall
+        cpu = thread_time() - cpu
+        if PROFILE_ALLOC:
+            (memory, peak) = tracemalloc.get_traced_memory()
+            (before_reset, max_peak) = allocs.pop()
+            memory += before_reset
+            peak = max(max_peak, before_reset + peak)
+        with profile_lock:
+            record = profile_records.setdefault(key + (stage,), {"calls": 0, "wall": 0.0, "cpu": 0.0})
+            record["calls"] += 1
+            record["wall"] += wall
+            record["cpu"] += cpu
+            if PROFILE_ALLOC:
+                record["net_alloc"] = record.get("net_alloc", 0) + memory
+                record["peak_alloc"] = max(record.get("peak_alloc", 0), peak)
+
+
+def write_profile_report(path: str) -> None:
+    """Writes the stages recorded since the start of the program to a json file.
+    
+    Args:
+        path: path of the json file to write.
+        
+    The report is a list of records with the following keys:
+        [city, dataset, stage, calls, wall, cpu, net_alloc, peak_alloc]
+        
+        wall and cpu are in seconds, net_alloc and peak_alloc are in bytes and only present with the alloc mode.
+    """
+    with profile_lock:
+        records = [dict(city=city, dataset=dataset, stage=stage, **value)
+                   for ((city, dataset, stage), value) in sorted(profile_records.items())]
+    with open(path, "w") as filehandle:
+        json.dump({"records": records}, filehandle, indent=1)
+
+
 # Multithread fetch implementation
 
 class DownloadWorker(Thread):
@@ -514,12 +667,25 @@ def download_commune_excel() -> None:
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-BASE_URL = "https://api.swisscom.com/layer/heatmaps/demo"
-TOKEN_URL = "https://consent.swisscom.com/o/oauth2/token"
+BASE_URL = os.environ.get("MIP_BASE_URL", "https://api.swisscom.com/layer/heatmaps/demo")
+TOKEN_URL = os.environ.get("MIP_TOKEN_URL", "https://consent.swisscom.com/o/oauth2/token")
 MAX_NB_TILES_REQUEST = 100
 headers = {"scs-version": "2"}
 client_id = ""  # customer key in the Swisscom digital market place
 client_secret = ""  # customer secret in the Swisscom digital market place
+# Profiling of fetch_data_city, MIP_PROFILE is a comma separated list of the following modes:
+#   time (or 1): wall and CPU time of every stage.
+#   alloc: time and allocations of every stage, tracemalloc slows down every allocation so the times are inflated.
+#   cprofile: cProfile dump of every city, adds an overhead to every function call so it should not be combined.
+PROFILE_MODES = set({"1": "time"}.get(m, m) for m in os.environ.get("MIP_PROFILE", "").split(",") if m != "")
+if not(PROFILE_MODES <= {"time", "alloc", "cprofile"}):
+    raise ValueError(f'Unknown MIP_PROFILE modes {PROFILE_MODES - {"time", "alloc", "cprofile"}}, expected time, alloc or cprofile')
+PROFILE = len(PROFILE_MODES & {"time", "alloc"}) > 0  # records the stages of fetch_data_city
+PROFILE_ALLOC = "alloc" in PROFILE_MODES
+PROFILE_CPROFILE = "cprofile" in PROFILE_MODES
+
+if PROFILE_ALLOC:
+    tracemalloc.start()
 
 if client_id == "":
     client_id = os.environ.get("CLIENT_ID", "")
@@ -561,6 +727,12 @@ def main():
 
     queue.put(-1)
     logger.info('Took %s', time() - ts)
+    if PROFILE:
+        if not(os.path.exists(os.path.join(".", "data", "profile"))):
+            os.mkdir(os.path.join(".", "data", "profile"))
+        report_path = os.path.join(".", "data", "profile", f'report{datetime.now().strftime("%Y%m%dT%H%M%S")}.json')
+        write_profile_report(report_path)
+        logger.info('Profile report written to %s', report_path)
 
 
     list_of_cities_path = os.path.join(".", "data","CityList.json")
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Local mock of the Swisscom MIP heatmaps API
+#
+# Serves deterministic data with the same format as the Swisscom MIP API so that
+# dataFetcher.py can be profiled without credentials and without network noise.
+
+import json
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process, Queue
+from urllib.parse import urlparse, parse_qs
+
+
+TOKEN_PATH = "/oauth2/token"
+API_PATH = "/layer/heatmaps/demo"
+TILE_SIZE = 0.001
+
+
+def tile_ids(municipalityId: int, nb_tiles: int) -> [int]:
+    """Returns the tile id's of a mock municipality.
+
+    Args:
+        municipalityId: id of the mock municipality.
+        nb_tiles: number of tiles of the municipality.
+    """
+    return [municipalityId * 100000 + i for i in range(nb_tiles)]
+
+
+def is_anonymized(tileId: int, hour: int = 0) -> bool:
+    """Returns True if the tile is missing from the response due to k-anonymization.
+    """
+    return (tileId + hour) % 10 == 0
+
+
+def age_distribution(tileId: int, hour: int = 0):
+    """Returns the age distribution of the tile, None one out of four times like the real API.
+    """
+    if (tileId + hour) % 4 == 0:
+        return None
+    weights = [1 + (tileId + hour + i) % 5 for i in range(4)]
+    return [w / sum(weights) for w in weights]
+
+
+def male_proportion(tileId: int, hour: int = 0) -> float:
+    return 0.45 + ((tileId * 7 + hour) % 10) / 100
+
+
+def score(tileId: int, hour: int = 0) -> int:
+    return 50 + (tileId * 13 + hour * 7) % 1000
+
+
+class MockApiHandler(BaseHTTPRequestHandler):
+    """Answers the requests done by dataFetcher.py, the municipalities are taken from the server.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data: dict, status: int = 200) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlparse(self.path).path != TOKEN_PATH:
+            self.send_json({"status": 404, "message": "Not found"}, 404)
+            return
+        self.send_json({"access_token": "mock", "token_type": "Bearer", "expires_in": 3600})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path[len(API_PATH):].strip("/").split("/")
+        tiles = [int(t) for t in parse_qs(url.query).get("tiles", [])]
+
+        if parts[:2] == ["grids", "municipalities"]:
+            municipalityId = int(parts[2])
+            nb_tiles = self.server.municipalities.get(municipalityId)
+            if nb_tiles == None:
+                self.send_json({"status": 400, "message": f"Unknown municipality {municipalityId}"})
+                return
+            self.send_json({"tiles": [
+                {"tileId": t,
+                 "ll": {"x": 7 + (t % 1000) * TILE_SIZE, "y": 46 + (t % 1000) * TILE_SIZE},
+                 "ur": {"x": 7 + (t % 1000 + 1) * TILE_SIZE, "y": 46 + (t % 1000 + 1) * TILE_SIZE}}
+                for t in tile_ids(municipalityId, nb_tiles)]})
+        elif parts[:1] == ["heatmaps"] and len(parts) == 4:
+            hour = datetime.fromisoformat(parts[3]).hour if parts[2] == "hourly" else 0
+            tiles = [t for t in tiles if not(is_anonymized(t, hour))]
+            if parts[1] == "dwell-demographics":
+                self.send_json({"tiles": [
+                    {"tileId": t, "ageDistribution": age_distribution(t, hour), "maleProportion": male_proportion(t, hour)}
+                    for t in tiles]})
+            elif parts[1] == "dwell-density":
+                self.send_json({"tiles": [{"tileId": t, "score": score(t, hour)} for t in tiles]})
+            else:
+                self.send_json({"status": 404, "message": "Not found"}, 404)
+        else:
+            self.send_json({"status": 404, "message": "Not found"}, 404)
+
+
+def serve_mock_api(municipalities: dict, port: int = 0, ready: Queue = None) -> None:
+    """Serves the mock API until the process is terminated.
+
+    Args:
+        municipalities: dictionary with as a key the municipality id and as a value the number of tiles.
+        port: port to listen on, 0 picks a free port.
+        ready: if given, the port the server listens on is put in it once the server is ready.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockApiHandler)
+    server.daemon_threads = True
+    server.municipalities = municipalities
+    if ready != None:
+        ready.put(server.server_port)
+    server.serve_forever()
+
+
+def start_mock_api(municipalities: dict, port: int = 0) -> (Process, int):
+    """Starts the mock API in a separate process.
+
+    The server runs in its own process so that its CPU time and allocations are not
+    counted in the profile of the client.
+
+    Args:
+        municipalities: dictionary with as a key the municipality id and as a value the number of tiles.
+        port: port to listen on, 0 picks a free port.
+
+    Returns:
+        The process of the server and the port it listens on. The urls to use are:
+            base url: f'http://127.0.0.1:{port}{API_PATH}'
+            token url: f'http://127.0.0.1:{port}{TOKEN_PATH}'
+        Call process.terminate() to stop it.
+    """
+    ready = Queue()
+    process = Process(target=serve_mock_api, args=(municipalities, port, ready), daemon=True)
+    process.start()
+    return process, ready.get(timeout=30)
+
+
+if __name__ == "__main__":
+    # Serves the cities used by profileFetcher.py on http://127.0.0.1:8000
+    import os
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "cities.json"), "r") as filehandle:
+        serve_mock_api({c["municipalityId"]: c["tiles"] for c in json.load(filehandle)}, 8000)
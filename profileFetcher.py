@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Profiling of the data fetcher
+#
+# Runs fetch_data_city against the local mock API with profiling enabled and compares the reports.
+#
+#   python profileFetcher.py run --passes alloc --output benchmarks/baseline.json
+#   python profileFetcher.py run
+#   python profileFetcher.py compare benchmarks/baseline.json benchmarks/reports/<report>.json
+
+
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+from multiprocessing import Process
+
+import pandas as pd
+
+from mockApi import start_mock_api, API_PATH, TOKEN_PATH
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CITIES_PATH = os.path.join(ROOT, "benchmarks", "cities.json")
+REPORTS_FOLDER = os.path.join(ROOT, "benchmarks", "reports")
+# Metrics kept from each pass, the other metrics of a pass are distorted by its profiling overhead.
+PASS_METRICS = {"time": ["calls", "wall", "cpu"], "alloc": ["calls", "net_alloc", "peak_alloc", "data_peak_alloc"]}
+METRICS = ["calls", "wall", "cpu", "net_alloc", "peak_alloc", "data_peak_alloc"]
+# Metrics that do not depend on the computer, the others are only compared with --times.
+GATED_METRICS = ["calls", "data_peak_alloc"]
+TIME_METRICS = ["wall", "cpu"]
+# Stages below these values are too small to be compared reliably.
+MIN_VALUES = {"calls": 0, "wall": 0.1, "cpu": 0.1, "net_alloc": 64 * 1024, "peak_alloc": 64 * 1024, "data_peak_alloc": 64 * 1024}
+# Stage measuring the memory used by the xz compressor itself, see run_pass().
+CALIBRATION = ("Calibration", "Empty", "storage")
+
+
+def run_pass(cities: list, mode: str, port: int, output: str, workers: int) -> None:
+    """Fetches the cities from the mock API with MIP_PROFILE set to mode.
+
+    Runs in its own process so that dataFetcher is imported with the profiling mode of the pass
+    and nothing is cached from a previous pass. The data is written to a temporary folder.
+
+    Args:
+        cities: list of {name, municipalityId, tiles}.
+        mode: MIP_PROFILE mode of the pass, time, alloc or cprofile.
+        port: port of the mock API.
+        output: path of the json report for the time and alloc modes, folder of the cProfile
+            dumps for the cprofile mode.
+        workers: number of DownloadWorker to use, 1 fetches the cities one after the other
+            which keeps the allocations of every stage separated.
+    """
+    os.environ["MIP_BASE_URL"] = f'http://127.0.0.1:{port}{API_PATH}'
+    os.environ["MIP_TOKEN_URL"] = f'http://127.0.0.1:{port}{TOKEN_PATH}'
+    os.environ["MIP_PROFILE"] = mode
+    os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+    os.environ.setdefault("CLIENT_ID", "mock")
+    os.environ.setdefault("CLIENT_SECRET", "mock")
+
+    work_folder = tempfile.mkdtemp(prefix="profileFetcher")
+    try:
+        os.chdir(work_folder)
+        import dataFetcher
+        dataFetcher.commune = pd.DataFrame(data={"GDENAME": [c["name"] for c in cities],
+                                                 "GDENR": [c["municipalityId"] for c in cities]})
+        if mode == "alloc":
+            # The xz compressor allocates close to 100MB whatever the size of the data, storing an
+            # empty DataFrame measures it so that it can be subtracted from the storage stages.
+            with dataFetcher.profile_dataset(*CALIBRATION[:2]):
+                with dataFetcher.profile_stage(CALIBRATION[2]):
+                    pd.DataFrame().to_pickle(f'{CALIBRATION[1]}.pkl.xz')
+        if workers == 1:
+            for c in cities:
+                dataFetcher.fetch_data_city(c["name"])
+        else:
+            queue = dataFetcher.Queue()
+            for x in range(workers):
+                dataFetcher.DownloadWorker(queue).start()
+            for c in cities:
+                queue.put(c["name"])
+            queue.join()
+            queue.put(-1)
+
+        if mode == "cprofile":
+            os.makedirs(output, exist_ok=True)
+            for c in cities:
+                shutil.copy(os.path.join("data", "profile", f'{c["name"]}.prof'), output)
+        else:
+            dataFetcher.write_profile_report(output)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+
+def run(cities_path: str, output: str, passes: [str], cprofile: bool, workers: int) -> None:
+    """Fetches the cities of cities_path from the mock API once per profiling pass and merges the reports.
+
+    The time pass runs without tracemalloc and cProfile so that the stage times do not include
+    their overhead, the alloc pass records the allocations and the cprofile pass the cProfile dumps.
+
+    Args:
+        cities_path: json file containing a list of {name, municipalityId, tiles}.
+        output: path of the json report. The cProfile dumps are written to a folder next to it.
+        passes: passes whose metrics are written to the report, time and/or alloc.
+        cprofile: if True, runs an additional pass writing a cProfile dump of every city.
+        workers: number of DownloadWorker to use.
+    """
+    with open(cities_path, "r") as filehandle:
+        cities = json.load(filehandle)
+    output = os.path.abspath(output)
+    prof_folder = os.path.splitext(output)[0] + "_prof"
+
+    (server, port) = start_mock_api({c["municipalityId"]: c["tiles"] for c in cities})
+    reports = []
+    try:
+        for mode in passes + (["cprofile"] if cprofile else []):
+            pass_output = prof_folder if mode == "cprofile" else f'{output}.{mode}'
+            process = Process(target=run_pass, args=(cities, mode, port, pass_output, workers))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f"The {mode} pass failed with exit code {process.exitcode}")
+            if mode != "cprofile":
+                report = load_report(pass_output)
+                os.remove(pass_output)
+                if mode == "alloc":
+                    report = add_data_peak_alloc(report)
+                report = report[PASS_METRICS[mode]]
+                # calls is the same for every pass, it is kept from the first one.
+                reports.append(report.drop(columns="calls") if len(reports) > 0 else report)
+    finally:
+        server.terminate()
+
+    report = pd.concat(reports, axis=1).reset_index()
+    with open(output, "w") as filehandle:
+        json.dump({"records": json.loads(report.to_json(orient="records"))}, filehandle, indent=1)
+    print(f"Report written to {output}" + (f", cProfile dumps in {prof_folder}" if cprofile else ""))
+
+
+def add_data_peak_alloc(report: pd.DataFrame) -> pd.DataFrame:
+    """Adds the data_peak_alloc column to the report of an alloc pass and removes the calibration stage.
+
+    data_peak_alloc is the peak_alloc of the stage without the memory used by the xz compressor
+    for the storage stages, it is the part of the peak that depends on the data. It is not defined
+    for the total stages as their peak is the one of the storage stage.
+    """
+    compressor = report.loc[CALIBRATION, "peak_alloc"]
+    report = report.drop(index=CALIBRATION[0], level="city")
+    stages = report.index.get_level_values("stage")
+    report["data_peak_alloc"] = report["peak_alloc"].where(stages != "storage", report["peak_alloc"] - compressor)
+    report.loc[stages == "total", "data_peak_alloc"] = None
+    return report
+
+
+def load_report(path: str) -> pd.DataFrame:
+    """Loads a report written by dataFetcher.write_profile_report() or run() as a DataFrame indexed by [city, dataset, stage].
+    """
+    with open(path, "r") as filehandle:
+        return pd.DataFrame(json.load(filehandle)["records"]).set_index(["city", "dataset", "stage"])
+
+
+def compare(baseline_path: str, report_path: str, tolerance: float, times: bool) -> bool:
+    """Compares a report to the baseline and prints the change of every stage.
+
+    Only the metrics that do not depend on the computer are used to detect regressions, the other
+    metrics present in both reports are printed for information:
+        calls: any increase is a regression.
+        data_peak_alloc: peak_alloc without the memory of the xz compressor, undefined for the total
+            stages. Stages whose data_peak_alloc is below 64KB in both reports are not checked.
+
+    Args:
+        baseline_path: report used as reference.
+        report_path: report to compare.
+        tolerance: relative increase above which a stage is considered as a regression, 0.25 is 25%.
+            Any increase of the number of calls is a regression.
+        times: if True, wall and cpu are also used to detect regressions. Only meaningful if both
+            reports were created on the same computer.
+
+    Returns:
+        True if no stage regressed by more than the tolerance and every stage of the baseline is in the report.
+    """
+    baseline = load_report(baseline_path)
+    report = load_report(report_path)
+    metrics = [m for m in METRICS if m in baseline.columns and m in report.columns]
+    gated = [m for m in metrics if m in GATED_METRICS or (times and m in TIME_METRICS)]
+    df = baseline[metrics].join(report[metrics], how="outer", lsuffix="_baseline", rsuffix="_report")
+
+    regressions = []
+    for m in metrics:
+        df[f'{m}_change'] = (df[f'{m}_report'] - df[f'{m}_baseline']) / df[f'{m}_baseline'].abs()
+        if m in gated:
+            regressed = (df[f'{m}_change'] > (0 if m == "calls" else tolerance)) & (df[[f'{m}_baseline', f'{m}_report']].max(axis=1) >= MIN_VALUES[m])
+            regressions += [(idx, m) for idx in df.index[regressed]]
+
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 250, "display.float_format", "{:.3f}".format):
+        print(df[[f'{m}_{s}' for m in metrics for s in ["baseline", "report", "change"]]])
+    print(f"Metrics used to detect regressions: {gated}")
+
+    missing = df.index[df[[f'{m}_report' for m in metrics]].isna().all(axis=1)]
+    for idx in missing:
+        print(f"{'/'.join(idx)} is missing from the report.")
+    for idx in df.index[df[[f'{m}_baseline' for m in metrics]].isna().all(axis=1)]:
+        print(f"{'/'.join(idx)} is not in the baseline.")
+    for (idx, m) in regressions:
+        print(f"{'/'.join(idx)}: {m} increased by {df.loc[idx, f'{m}_change']:.0%}")
+    return len(regressions) == 0 and len(missing) == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profiles fetch_data_city against a local mock of the Swisscom MIP API.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Runs the pipeline and writes a report.")
+    run_parser.add_argument("--cities", default=CITIES_PATH, help="json file listing the mock cities.")
+    run_parser.add_argument("--output", default=os.path.join(REPORTS_FOLDER, f'report{datetime.now().strftime("%Y%m%dT%H%M%S")}.json'),
+                            help="path of the report.")
+    run_parser.add_argument("--passes", default="time,alloc", help="comma separated passes written to the report, time and/or alloc.")
+    run_parser.add_argument("--cprofile", action="store_true", help="runs an additional pass writing a cProfile dump of every city.")
+    run_parser.add_argument("--workers", type=int, default=1, help="number of download workers.")
+
+    compare_parser = subparsers.add_parser("compare", help="Compares a report to a baseline.")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("report")
+    compare_parser.add_argument("--tolerance", type=float, default=0.25, help="relative increase considered as a regression.")
+    compare_parser.add_argument("--times", action="store_true", help="also detects regressions of wall and cpu, for reports created on the same computer.")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        passes = args.passes.split(",")
+        if not(set(passes) <= set(PASS_METRICS)):
+            parser.error(f"unknown passes {set(passes) - set(PASS_METRICS)}, expected time or alloc")
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        run(args.cities, args.output, passes, args.cprofile, args.workers)
+    elif not(compare(args.baseline, args.report, args.tolerance, args.times)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()